@@ -2,23 +2,37 @@
 from __future__ import annotations
 
 import os
+import html
+import asyncio
+import pickle
+import sqlite3
 import logging
-from typing import Dict, List, Literal, Optional
+from functools import lru_cache
+from types import MappingProxyType
+from urllib.parse import urlparse
+from typing import Any, Dict, Literal, Optional
 
 from telegram import (
     Update, Message,
     InlineKeyboardMarkup, InlineKeyboardButton,
+    Contact, Dice, Location, Poll, Sticker, Venue, VideoNote,
 )
-from telegram.constants import ParseMode
+from telegram.constants import MessageLimit, ParseMode
+from telegram.error import TelegramError
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, MessageHandler,
-    ContextTypes, CallbackQueryHandler, filters, PicklePersistence
+    ContextTypes, CallbackQueryHandler, filters,
+    AIORateLimiter, BasePersistence, PersistenceInput,
 )
 
 # ---------------- Config ----------------
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_CHAT_ID_ENV = os.getenv("ADMIN_CHAT_ID")  # may be negative for supergroups
 AUTO_REPLY = os.getenv("AUTO_REPLY", "1") in {"1", "true", "True", "yes", "YES"}
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # public https URL; unset = long polling
+WEBHOOK_PORT_ENV = os.getenv("WEBHOOK_PORT", "8443")
+WH_SECRET = os.getenv("WH_SECRET")  # required in webhook mode
 
 Lang = Literal["ru", "en", "uk"]
 
@@ -36,32 +50,44 @@ LABEL_BY_ID: Dict[Lang, Dict[str, str]] = {
     "uk": {c["id"]: c["uk"] for c in CATEGORY_DEFS},
 }
 
-PROMPTS = {
+LABEL_TO_ID: Dict[Lang, Dict[str, str]] = {
+    lang: {label: cid for cid, label in labels.items()} for lang, labels in LABEL_BY_ID.items()
+}
+
+PROMPTS = MappingProxyType({
     "ru": "Выберите категорию:",
     "en": "Choose a category:",
     "uk": "Оберіть категорію:",
-}
+})
 
-TYPE_PROMPT = {
+TYPE_PROMPT = MappingProxyType({
     "ru": "✍️ Вы выбрали: «{label}». Напишите ваше сообщение, и я передам его администратору.",
     "en": "✍️ You chose: “{label}”. Please type your message and I will forward it to the administrator.",
     "uk": "✍️ Ви обрали: «{label}». Напишіть своє повідомлення, і я передам його адміністратору.",
-}
+})
 
-CHANGE_LANG_BTN = {"ru": "🌐 Сменить язык", "en": "🌐 Change language", "uk": "🌐 Змінити мову"}
-FINISH_BTN      = {"ru": "🔚 Завершить работу", "en": "🔚 Finish", "uk": "🔚 Завершити"}
+CHANGE_LANG_BTN = MappingProxyType({"ru": "🌐 Сменить язык", "en": "🌐 Change language", "uk": "🌐 Змінити мову"})
+FINISH_BTN      = MappingProxyType({"ru": "🔚 Завершить работу", "en": "🔚 Finish", "uk": "🔚 Завершити"})
 
-ACK_TEXT = {
+ACK_TEXT = MappingProxyType({
     "ru": "✅ Спасибо! Мы свяжемся с вами.",
     "en": "✅ Thank you! We will get back to you.",
     "uk": "✅ Дякуємо! Ми зв'яжемося з вами.",
-}
+})
 
-GOODBYE_TEXT = {
+GOODBYE_TEXT = MappingProxyType({
     "ru": "✅ Спасибо за общение! Чтобы вернуться, нажмите /start",
     "en": "✅ Thank you for chatting! To return, just type /start",
     "uk": "✅ Дякуємо за спілкування! Щоб повернутися, натисніть /start",
-}
+})
+
+HEADER_TMPL = (
+    "📨 Новое обращение\n"
+    "• Пользователь: {name} (id={uid})\n"
+    "• Язык: {lang}\n"
+    "• Категория: {cat}\n"
+    "• Из чата: {chat}"
+)
 
 TRILINGUAL_GREETING = (
     "<b>Привет!</b> Пастор Александр Ханчевский рад с тобой пообщаться.\n"
@@ -72,6 +98,10 @@ TRILINGUAL_GREETING = (
     "Оберіть зручну для вас мову спілкування нижче."
 )
 
+# attachments that Telegram does not allow a caption on
+_NO_CAPTION_TYPES = (Contact, Dice, Location, Poll, Sticker, Venue, VideoNote)
+
+@lru_cache(maxsize=1)
 def admin_chat_id() -> int:
     if not ADMIN_CHAT_ID_ENV:
         raise RuntimeError("Set ADMIN_CHAT_ID env var (admin/group chat id)")
@@ -80,34 +110,64 @@ def admin_chat_id() -> int:
     except ValueError:
         raise RuntimeError("ADMIN_CHAT_ID must be an integer (can be negative for groups)")
 
+# Keyboards are static per language, so build them once and hand out the same markup
+_LANG_BUTTONS = (
+    InlineKeyboardButton("Русский 🇷🇺",  callback_data="lang:ru"),
+    InlineKeyboardButton("English 🇬🇧",  callback_data="lang:en"),
+    InlineKeyboardButton("Українська 🇺🇦", callback_data="lang:uk"),
+)
+_LANG_KB = InlineKeyboardMarkup((_LANG_BUTTONS,))
+
+_MENU_KB: Dict[Lang, InlineKeyboardMarkup] = {
+    lang: InlineKeyboardMarkup(
+        [[InlineKeyboardButton(LABEL_BY_ID[lang][c["id"]], callback_data=f"cat:{c['id']}")] for c in CATEGORY_DEFS]
+        + [[InlineKeyboardButton(CHANGE_LANG_BTN[lang], callback_data="change_lang")]]
+        + [[InlineKeyboardButton(FINISH_BTN[lang],      callback_data="finish")]]
+    )
+    for lang in ("ru", "en", "uk")
+}
+
 def lang_inline_keyboard() -> InlineKeyboardMarkup:
-    rows = [[
-        InlineKeyboardButton("Русский 🇷🇺",  callback_data="lang:ru"),
-        InlineKeyboardButton("English 🇬🇧",  callback_data="lang:en"),
-        InlineKeyboardButton("Українська 🇺🇦", callback_data="lang:uk"),
-    ]]
-    return InlineKeyboardMarkup(rows)
+    return _LANG_KB
 
 def menu_inline_keyboard(lang: Lang) -> InlineKeyboardMarkup:
-    rows = []
-    for c in CATEGORY_DEFS:
-        rows.append([InlineKeyboardButton(LABEL_BY_ID[lang][c["id"]], callback_data=f"cat:{c['id']}")])
-    rows.append([InlineKeyboardButton(CHANGE_LANG_BTN[lang], callback_data="change_lang")])
-    rows.append([InlineKeyboardButton(FINISH_BTN[lang],      callback_data="finish")])
-    return InlineKeyboardMarkup(rows)
+    return _MENU_KB[lang]
 
 def is_menu_label(text: str, lang: Optional[Lang]) -> Optional[str]:
-    if not lang or not text:
-        return None
-    for cid, label in LABEL_BY_ID[lang].items():
-        if text == label:
-            return cid
-    return None
+    return LABEL_TO_ID[lang].get(text) if lang and text else None
 
-async def show_menu(update_or_msg, lang: Lang) -> None:
-    msg = update_or_msg.effective_message if isinstance(update_or_msg, Update) else update_or_msg
+async def show_menu_for_msg(msg: Message, lang: Lang) -> None:
     await msg.reply_text(PROMPTS[lang], reply_markup=menu_inline_keyboard(lang))
 
+def _tg_len(text: str) -> int:
+    # Telegram counts message/caption limits in UTF-16 code units
+    return len(text.encode("utf-16-le")) // 2
+
+async def forward_to_admin(bot, msg: Message, header: str) -> None:
+    """Deliver header + user content to the admin chat, in one API call when possible."""
+    admin_id = admin_chat_id()
+    head = html.escape(header)
+    if msg.text is not None:
+        if _tg_len(header) + 2 + _tg_len(msg.text) <= MessageLimit.MAX_TEXT_LENGTH:
+            await bot.send_message(chat_id=admin_id, text=f"{head}\n\n{msg.text_html}", parse_mode=ParseMode.HTML)
+            return
+    elif msg.effective_attachment and not isinstance(msg.effective_attachment, _NO_CAPTION_TYPES):
+        body = msg.caption or ""
+        if _tg_len(header) + 2 + _tg_len(body) <= MessageLimit.CAPTION_LENGTH:
+            caption = f"{head}\n\n{msg.caption_html}" if body else head
+            await msg.copy(chat_id=admin_id, caption=caption, parse_mode=ParseMode.HTML)
+            return
+    # too long to combine, or a message type that cannot carry a caption; forwards run
+    # concurrently, so thread the copy under its header rather than relying on order
+    sent = await bot.send_message(chat_id=admin_id, text=header)
+    await msg.copy(chat_id=admin_id, reply_to_message_id=sent.message_id)
+
+async def _forward_safely(bot, msg: Message, header: str) -> None:
+    try:
+        await forward_to_admin(bot, msg, header)
+    except Exception as e:
+        logging.exception("Failed to copy message to admin: %s", e)
+
 # ---------------- Handlers ----------------
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     context.user_data.clear()
@@ -131,7 +191,7 @@ async def on_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             ud.pop("category_id", None)
             await query.answer()
             # go straight to category menu (no big greeting)
-            await query.message.reply_text(PROMPTS[lang], reply_markup=menu_inline_keyboard(lang))
+            await show_menu_for_msg(query.message, lang)
             return
 
         if data == "change_lang":
@@ -175,65 +235,173 @@ async def on_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             pass
 
 async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    ud = context.user_data
     msg: Message = update.effective_message
     text = msg.text or ""
-    lang: Optional[Lang] = context.user_data.get("lang")
-    category_id: Optional[str] = context.user_data.get("category_id")
+    lang: Optional[Lang] = ud.get("lang")
+    category_id: Optional[str] = ud.get("category_id")
 
-    typed_cid = is_menu_label(text, lang)
-    if typed_cid:
-        context.user_data["category_id"] = typed_cid
-        # also nudge to type message
-        label = LABEL_BY_ID[lang][typed_cid]
-        await msg.reply_text(TYPE_PROMPT[lang].format(label=label))
+    if not lang:
+        await msg.reply_text("Choose language / Выберите язык / Оберіть мову:", reply_markup=lang_inline_keyboard())
         return
 
-    if category_id and lang:
+    if category_id:
         label = LABEL_BY_ID[lang].get(category_id, category_id)
-        header = (
-            f"📨 Новое обращение\n"
-            f"• Пользователь: {msg.from_user.full_name} (id={msg.from_user.id})\n"
-            f"• Язык: {lang}\n"
-            f"• Категория: {label}\n"
-            f"• Из чата: {update.effective_chat.id}"
+        header = HEADER_TMPL.format(
+            name=msg.from_user.full_name, uid=msg.from_user.id, lang=lang, cat=label, chat=msg.chat_id,
         )
-        try:
-            await context.bot.send_message(chat_id=admin_chat_id(), text=header)
-            await msg.copy(chat_id=admin_chat_id())
-        except Exception as e:
-            logging.exception("Failed to copy message to admin: %s", e)
+        # don't make the user wait on the admin round trip
+        # (PTB keeps a reference and awaits it on shutdown, so the forward isn't lost)
+        context.application.create_task(_forward_safely(context.bot, msg, header), update=update)
+
+        ud.pop("category_id", None)
 
         if AUTO_REPLY and lang in ("ru", "en", "uk"):
             try:
                 await msg.reply_text(ACK_TEXT[lang])
-            except Exception:
-                pass
-
-        context.user_data.pop("category_id", None)
-        await show_menu(update, lang)
+            except TelegramError as e:
+                # the limiter only retries flood waits; don't let other failures skip the menu
+                logging.warning("Failed to send ack: %s", e)
+        await show_menu_for_msg(msg, lang)
         return
 
-    if not lang:
-        await msg.reply_text("Choose language / Выберите язык / Оберіть мову:", reply_markup=lang_inline_keyboard())
+    typed_cid = is_menu_label(text, lang)
+    if typed_cid:
+        ud["category_id"] = typed_cid
+        # also nudge to type message
+        label = LABEL_BY_ID[lang][typed_cid]
+        await msg.reply_text(TYPE_PROMPT[lang].format(label=label))
         return
 
-    await show_menu(update, lang)
+    await show_menu_for_msg(msg, lang)
+
+# ---------------- Persistence ----------------
+class SQLitePersistence(BasePersistence):
+    """Keeps user_data in SQLite, one row per user, so a flush only writes the users that changed."""
+
+    def __init__(self, filepath: str, update_interval: float = 60):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._db = sqlite3.connect(filepath, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, data BLOB NOT NULL)")
+        self._db.commit()
+        # PTB flushes changed users concurrently; sqlite3 connections must not be shared across threads at once
+        self._lock = asyncio.Lock()
+
+    async def _write(self, sql: str, params: tuple) -> None:
+        def run() -> None:
+            self._db.execute(sql, params)
+            self._db.commit()
+        async with self._lock:
+            await asyncio.to_thread(run)
+
+    async def get_user_data(self) -> Dict[int, Dict[Any, Any]]:
+        rows = self._db.execute("SELECT user_id, data FROM user_data").fetchall()
+        return {uid: pickle.loads(blob) for uid, blob in rows}
+
+    async def update_user_data(self, user_id: int, data: Dict[Any, Any]) -> None:
+        await self._write(
+            "INSERT INTO user_data (user_id, data) VALUES (?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data",
+            (user_id, pickle.dumps(data)),
+        )
+
+    async def drop_user_data(self, user_id: int) -> None:
+        await self._write("DELETE FROM user_data WHERE user_id = ?", (user_id,))
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def flush(self) -> None:
+        async with self._lock:
+            self._db.close()
+
+    # only user_data is stored; the rest of the interface is unused
+    async def get_chat_data(self) -> Dict[int, Dict[Any, Any]]:
+        return {}
+
+    async def get_bot_data(self) -> Dict[Any, Any]:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def get_conversations(self, name: str) -> Dict:
+        return {}
+
+    async def update_chat_data(self, chat_id: int, data: Dict[Any, Any]) -> None:
+        pass
+
+    async def update_bot_data(self, data: Dict[Any, Any]) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: Dict[Any, Any]) -> None:
+        pass
 
 # ---------------- Entrypoint ----------------
 def main() -> None:
     logging.basicConfig(level=logging.INFO)
 
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass  # optional; fall back to the stock asyncio loop
+
     if not BOT_TOKEN:
         raise RuntimeError("Set BOT_TOKEN env var")
     _ = admin_chat_id()
-
-    persistence = PicklePersistence(filepath="bot_state.pkl")
-
-    app = ApplicationBuilder().token(BOT_TOKEN).persistence(persistence).build()
+    if WEBHOOK_URL:
+        if not WH_SECRET:
+            raise RuntimeError("Set WH_SECRET env var when WEBHOOK_URL is set")
+        try:
+            webhook_port = int(WEBHOOK_PORT_ENV)
+        except ValueError:
+            raise RuntimeError("WEBHOOK_PORT must be an integer")
+        if not 0 < webhook_port < 65536:
+            raise RuntimeError("WEBHOOK_PORT must be between 1 and 65535")
+
+    persistence = SQLitePersistence(filepath="bot_state.sqlite3")
+
+    app = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .persistence(persistence)
+        # larger connection pool, with HTTP/2 so concurrent calls can share a connection
+        .request(HTTPXRequest(connection_pool_size=256, http_version="2", pool_timeout=5))
+        .get_updates_request(HTTPXRequest(http_version="2"))
+        .concurrent_updates(True)  # a slow chat must not stall the others
+        .rate_limiter(AIORateLimiter(overall_max_rate=30, overall_time_period=1, max_retries=3))
+        .build()
+    )
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CallbackQueryHandler(on_cb))
     app.add_handler(MessageHandler(~filters.COMMAND, on_message))
-    app.run_polling()
+    # only what the handlers above consume; Telegram drops the rest server-side
+    allowed = [Update.MESSAGE, Update.CALLBACK_QUERY]
+    if WEBHOOK_URL:
+        # TLS is terminated by the reverse proxy in front of us
+        app.run_webhook(
+            listen="0.0.0.0", port=webhook_port, webhook_url=WEBHOOK_URL, secret_token=WH_SECRET,
+            url_path=urlparse(WEBHOOK_URL).path.lstrip("/"),  # serve the same path Telegram posts to
+            allowed_updates=allowed,
+        )
+    else:
+        app.run_polling(allowed_updates=allowed)
 
 if __name__ == "__main__":
     main()